@@ -1,29 +1,199 @@
 import os
 import uuid
-import shutil
+import asyncio
+import subprocess
+import tempfile
+import threading
 import requests
 import json
-from fastapi import FastAPI, BackgroundTasks
+import time
+import logging
+import aiohttp
+import aiofiles
+import av
+import math
+import redis
+import redis.asyncio
+from contextlib import contextmanager
+from fractions import Fraction
+from functools import lru_cache
+from PIL import Image, ImageDraw, ImageFont
+from prometheus_client import CollectorRegistry, Histogram, multiprocess, start_http_server
+from celery import Celery
+from celery.signals import worker_init, worker_process_init
+from fastapi import FastAPI
 from pydantic import BaseModel
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
 from typing import List
 
 # Import các lớp từ moviepy theo API phiên bản mới
-from moviepy import AudioFileClip, ImageClip, TextClip, CompositeVideoClip
+from moviepy import AudioFileClip, ImageClip
 from moviepy.audio.AudioClip import concatenate_audioclips
+from moviepy.config import FFMPEG_BINARY
 
 # Import cho Google Drive API
+from google.auth.transport.requests import Request as GoogleAuthRequest
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaFileUpload
 
 app = FastAPI()
+logger = logging.getLogger(__name__)
 
-# CSDL giả lưu trạng thái video (video_id -> {status: ..., url: ...})
-video_db = {}
+# Drive service được tạo ở lần upload đầu tiên rồi dùng lại (xem _get_drive_service)
+_drive_service = None
+_drive_lock = threading.Lock()
+
+# Trạng thái video lưu trên Redis (hash "video:<video_id>" -> {status, url, task_id, webhook_url})
+# để mọi worker uvicorn cùng thấy và không mất khi khởi động lại.
+# Endpoint async dùng client async; process_video chạy trong Celery worker nên dùng client sync.
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+video_db = redis.asyncio.from_url(REDIS_URL, decode_responses=True)
+video_db_sync = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+# Bản ghi video tự xoá sau 1 ngày
+VIDEO_TTL_SECONDS = 24 * 60 * 60
+
+def _video_key(video_id: str) -> str:
+    return f"video:{video_id}"
+
+def _update_video(video_id: str, mapping: dict):
+    """
+    Ghi trạng thái video từ worker và đặt lại TTL trong cùng 1 pipeline,
+    để nếu key đã hết hạn trước khi task xong thì key tạo lại cũng tự xoá.
+    """
+    with video_db_sync.pipeline(transaction=True) as pipe:
+        pipe.hset(_video_key(video_id), mapping=mapping)
+        pipe.expire(_video_key(video_id), VIDEO_TTL_SECONDS)
+        pipe.execute()
+
+def _video_record(data: dict) -> dict:
+    """Chuyển hash đọc từ Redis về dạng trả cho client (chuỗi rỗng -> None)"""
+    return {
+        "status": data.get("status"),
+        "url": data.get("url") or None,
+        "task_id": data.get("task_id"),
+        "webhook_url": data.get("webhook_url") or None,
+    }
 
 # Giả sử bạn có Roboto-Regular.ttf trong thư mục fonts/static
 font_path = "fonts/static/Roboto-Regular.ttf"
 
+# ID của thư mục trên Google Drive mà bạn muốn upload file vào
+DRIVE_FOLDER_ID = '1Xz3fU5KTOwXsibOyAqxhR8StvJkIYYJD'
+DRIVE_SCOPES = ['https://www.googleapis.com/auth/drive']
+# Kích thước mỗi chunk khi upload resumable (phải là bội số của 256 KiB)
+DRIVE_UPLOAD_CHUNKSIZE = 8 * 1024 * 1024
+# Các mã lỗi tạm thời của Drive API nên thử lại
+DRIVE_RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Số lần gọi tối đa (kể cả lần đầu) cho Drive API và webhook khi gặp lỗi tạm thời
+RETRY_ATTEMPTS = 6
+# Thời gian chờ tối đa giữa 2 lần thử lại
+RETRY_MAX_WAIT_SECONDS = 60
+WEBHOOK_TIMEOUT_SECONDS = 30
+
+# Số video được encode cùng lúc trên mỗi Celery worker (mỗi video chạy trong 1 process riêng)
+MAX_CONCURRENT_TASKS = int(os.environ.get("MAX_CONCURRENT_TASKS", "2"))
+# Số luồng mỗi lần encode libx264 được dùng: chia đều CPU cho các video encode cùng lúc,
+# tránh mỗi encoder tự mở số luồng bằng số CPU (threads=auto) làm các process tranh nhau CPU
+ENCODE_THREADS = max(1, (os.cpu_count() or 1) // MAX_CONCURRENT_TASKS)
+
+# Thời gian xử lý 1 video lâu nhất dự kiến (tải audio, dựng, upload), chưa tính thời gian chờ thử lại
+TASK_MAX_WORK_SECONDS = 2 * 60 * 60
+# Redis broker giao lại task chưa ack sau visibility_timeout (mặc định 1 giờ). Vì task chỉ ack khi xong
+# (task_acks_late), timeout phải dài hơn task lâu nhất, nếu không task đang chạy sẽ bị giao thêm cho
+# worker khác (encode và upload trùng, bộ đếm attempts tưởng worker bị mất). Cộng thêm thời gian chờ
+# thử lại tối đa của Drive và webhook (mỗi bên RETRY_ATTEMPTS lần x RETRY_MAX_WAIT_SECONDS).
+TASK_VISIBILITY_TIMEOUT_SECONDS = TASK_MAX_WORK_SECONDS + 2 * RETRY_ATTEMPTS * RETRY_MAX_WAIT_SECONDS
+
+# Việc dựng video chạy ở Celery worker (process riêng, Redis làm broker) để process API
+# chỉ nhận request; task không mất khi API khởi động lại và worker scale độc lập với API.
+# Chạy worker: celery -A main:celery_app worker
+celery_app = Celery("main", broker=REDIS_URL)
+celery_app.conf.update(
+    worker_concurrency=MAX_CONCURRENT_TASKS,
+    # Chỉ ack sau khi xong và không nhận trước task, để 1 worker đang encode không giữ hàng đợi
+    task_acks_late=True,
+    worker_prefetch_multiplier=1,
+    # Process con bị kill giữa lúc encode (vd: hết thời gian chờ khi deploy) thì task được
+    # đưa lại vào hàng đợi để worker khác làm lại, thay vì kẹt ở trạng thái "processing"
+    task_reject_on_worker_lost=True,
+    broker_transport_options={"visibility_timeout": TASK_VISIBILITY_TIMEOUT_SECONDS},
+)
+# Số lần giao 1 task tối đa (lần đầu + các lần giao lại sau khi process con bị kill)
+MAX_TASK_ATTEMPTS = 3
+
+def _refresh_drive_credentials():
+    try:
+        _get_drive_credentials().refresh(GoogleAuthRequest())
+    except Exception as e:
+        # Token sẽ được lấy lại khi upload
+        logger.warning("Không lấy trước được token Google Drive: %s", e)
+
+@worker_process_init.connect
+def _warm_drive_credentials(**kwargs):
+    """
+    Lấy access token Drive ngay khi process worker khởi động để lần upload đầu không phải chờ.
+    Chạy ở thread nền: Celery kill process con nếu handler worker_process_init chạy quá
+    worker_proc_alive_timeout (4 giây), trong khi request lấy token có thể chờ tới 120 giây.
+    """
+    if not os.environ.get("GOOGLE_SERVICE_ACCOUNT_INFO"):
+        return
+    threading.Thread(target=_refresh_drive_credentials, daemon=True).start()
+
+@worker_init.connect
+def _start_metrics_server(**kwargs):
+    """
+    Mở endpoint Prometheus trên cổng METRICS_PORT của worker (nếu có cấu hình).
+    Task chạy ở các process con nên cần PROMETHEUS_MULTIPROC_DIR để gộp số liệu của chúng.
+    """
+    port = os.environ.get("METRICS_PORT")
+    if not port or "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    start_http_server(int(port), registry=registry)
+
+# Thời gian từng bước (download, concat, render, upload) của process_video
+PROCESS_VIDEO_STEP_SECONDS = Histogram(
+    "process_video_step_seconds",
+    "Thời gian từng bước tạo video",
+    ["step"],
+    buckets=(0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600),
+)
+
+# Số file audio tải song song tối đa, tránh mở quá nhiều kết nối làm server trả 429
+DOWNLOAD_CONCURRENCY = 5
+# Ghi file theo khối 64 KiB (copyfileobj mặc định chỉ 16 KiB) để ít vòng lặp Python hơn
+DOWNLOAD_CHUNK_SIZE = 1 << 16
+# File nhỏ hơn ngưỡng này được tải vào bộ nhớ rồi ghi 1 lần thay vì ghi theo khối
+SMALL_DOWNLOAD_BYTES = 1 << 20
+
+# Video chỉ là 1 ảnh tĩnh nên 1 khung hình/giây là đủ, giảm 24 lần số khung phải encode
+# so với 24 fps mà hình ảnh khi phát không đổi (YouTube chấp nhận 1 fps cho video ảnh tĩnh)
+VIDEO_FPS = 1
+
+# Cấu hình cho từng encoder H.264 (PyAV), thử lần lượt theo thứ tự khai báo.
+# pix_fmt: định dạng khung hình đưa vào encoder (NVENC chỉ nhận yuv420p/nv12/p010le),
+# options: tham số của encoder. Video là ảnh tĩnh, không có chuyển động để tìm,
+# nên dùng preset nhanh nhất và chất lượng cố định thay vì preset chậm.
+VIDEO_ENCODERS = {
+    "h264_nvenc": {
+        "pix_fmt": "yuv420p",
+        "options": {"preset": "p1", "tune": "ull", "rc": "constqp", "qp": "23"},
+    },
+    "h264_videotoolbox": {
+        "pix_fmt": "yuv420p",
+        "options": {"b": "1M"},
+    },
+    # Encoder CPU, dùng khi không có encoder phần cứng nào chạy được
+    "libx264": {
+        "pix_fmt": "yuv420p",
+        # stillimage dồn bitrate cho chất lượng khung hình tĩnh
+        "options": {"preset": "ultrafast", "tune": "stillimage", "crf": "23", "threads": str(ENCODE_THREADS)},
+    },
+}
+
 class VideoRequest(BaseModel):
     task_id: str
     story_name: str
@@ -33,60 +203,153 @@ class VideoRequest(BaseModel):
     webhook_url: str | None = None
 
 @app.post("/create_video")
-async def create_video(video_req: VideoRequest, background_tasks: BackgroundTasks):
+async def create_video(video_req: VideoRequest):
     video_id = str(uuid.uuid4())
-    # Khởi tạo trạng thái video là "processing"
-    video_db[video_id] = {
-        "status": "processing",
-        "url": None,
-        "task_id": video_req.task_id,
-        "webhook_url": video_req.webhook_url
-    }
-    background_tasks.add_task(process_video, video_id, video_req.story_name, video_req.chapter, video_req.image_path,video_req.audio_urls)
+    # Khởi tạo trạng thái video là "processing" (Redis không lưu None nên dùng chuỗi rỗng)
+    async with video_db.pipeline(transaction=True) as pipe:
+        pipe.hset(_video_key(video_id), mapping={
+            "status": "processing",
+            "url": "",
+            "task_id": video_req.task_id,
+            "webhook_url": video_req.webhook_url or ""
+        })
+        pipe.expire(_video_key(video_id), VIDEO_TTL_SECONDS)
+        await pipe.execute()
+    # delay() gửi lên broker bằng lệnh Redis đồng bộ, chạy trong thread để không chặn event loop
+    await asyncio.to_thread(
+        render_task.delay,
+        video_id, video_req.story_name, video_req.chapter, video_req.image_path, video_req.audio_urls
+    )
     return {"video_id": video_id, "status": "queued", "task_id": video_req.task_id}
 
 @app.get("/video_status/{video_id}")
 async def video_status(video_id: str):
-    if video_id not in video_db:
+    video = await video_db.hgetall(_video_key(video_id))
+    if not video:
         return {"error": "Video not found"}
-    return video_db[video_id]
+    return _video_record(video)
 
-def download_file(url: str, dest_path: str):
+async def download_file(session: aiohttp.ClientSession, url: str, dest_path: str):
     """Tải file từ URL và lưu vào dest_path"""
-    response = requests.get(url, stream=True)
-    if response.status_code == 200:
-        with open(dest_path, 'wb') as out_file:
-            shutil.copyfileobj(response.raw, out_file)
-        return dest_path
+    async with session.get(url) as response:
+        if response.status != 200:
+            raise Exception("Failed to download file from url: " + url)
+        async with aiofiles.open(dest_path, 'wb') as out_file:
+            # File nhỏ (biết trước qua Content-Length) đọc 1 lần rồi ghi 1 lần,
+            # file lớn hoặc không rõ kích thước thì ghi dần theo từng khối
+            if response.content_length is not None and response.content_length < SMALL_DOWNLOAD_BYTES:
+                await out_file.write(await response.read())
+            else:
+                async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    await out_file.write(chunk)
+    return dest_path
+
+async def download_files(urls: List[str], dest_paths: List[str]):
+    """Tải song song nhiều file, tối đa DOWNLOAD_CONCURRENCY file cùng lúc"""
+    semaphore = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+
+    async def bounded_download(session, url, dest_path):
+        async with semaphore:
+            return await download_file(session, url, dest_path)
+
+    # Các audio thường cùng host nên cache DNS thay vì phân giải lại cho mỗi kết nối
+    connector = aiohttp.TCPConnector(limit=DOWNLOAD_CONCURRENCY, ttl_dns_cache=300)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        return await asyncio.gather(
+            *[bounded_download(session, url, path) for url, path in zip(urls, dest_paths)]
+        )
+
+def _retry_after_seconds(exc: BaseException) -> float | None:
+    """Lấy thời gian chờ server yêu cầu qua header Retry-After (nếu có)"""
+    if isinstance(exc, HttpError):
+        headers = exc.resp
+    elif isinstance(exc, requests.HTTPError) and exc.response is not None:
+        headers = exc.response.headers
     else:
-        raise Exception("Failed to download file from url: " + url)
+        return None
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
 
-def upload_to_googledrive(file_path: str) -> str:
+_exponential_wait = wait_exponential(multiplier=1, min=1, max=RETRY_MAX_WAIT_SECONDS)
+
+def _wait_retry_after(retry_state) -> float:
     """
-    Upload file lên Google Drive sử dụng service account.
-    Lấy thông tin credentials từ biến môi trường GOOGLE_SERVICE_ACCOUNT_INFO.
+    Chờ theo Retry-After của server nếu có (tối đa RETRY_MAX_WAIT_SECONDS để không giữ worker quá lâu),
+    nếu không thì chờ tăng dần theo cấp số nhân
+    """
+    delay = _retry_after_seconds(retry_state.outcome.exception())
+    if delay is not None:
+        return min(delay, RETRY_MAX_WAIT_SECONDS)
+    return _exponential_wait(retry_state)
+
+def _is_retryable_drive_error(exc: BaseException) -> bool:
+    return isinstance(exc, HttpError) and exc.resp.status in DRIVE_RETRY_STATUSES
+
+def _is_retryable_webhook_error(exc: BaseException) -> bool:
+    if isinstance(exc, requests.HTTPError):
+        return exc.response is not None and (exc.response.status_code == 429 or exc.response.status_code >= 500)
+    return isinstance(exc, (requests.ConnectionError, requests.Timeout))
+
+@retry(
+    stop=stop_after_attempt(RETRY_ATTEMPTS),
+    wait=_wait_retry_after,
+    retry=retry_if_exception(_is_retryable_drive_error),
+    reraise=True,
+)
+def _execute_with_backoff(call):
+    """Gọi Drive API, thử lại khi gặp lỗi tạm thời (429/5xx) để lỗi thoáng qua chỉ làm chậm chứ không làm hỏng task"""
+    return call()
+
+@lru_cache(maxsize=None)
+def _get_drive_credentials() -> service_account.Credentials:
+    """
+    Đọc service account từ biến môi trường GOOGLE_SERVICE_ACCOUNT_INFO và tạo credentials một lần.
+    Parse JSON và nạp private key (PEM) tốn thời gian nên được cache cho cả process.
     """
     # Lấy thông tin credentials từ biến môi trường (JSON string)
     service_account_info_str = os.environ.get("GOOGLE_SERVICE_ACCOUNT_INFO")
     if not service_account_info_str:
         raise Exception("Environment variable GOOGLE_SERVICE_ACCOUNT_INFO not set")
     service_account_info = json.loads(service_account_info_str)
+    return service_account.Credentials.from_service_account_info(
+        service_account_info, scopes=DRIVE_SCOPES)
 
-    # ID của thư mục trên Google Drive mà bạn muốn upload file vào
-    FOLDER_ID = '1Xz3fU5KTOwXsibOyAqxhR8StvJkIYYJD'
-    SCOPES = ['https://www.googleapis.com/auth/drive']
-    credentials = service_account.Credentials.from_service_account_info(
-        service_account_info, scopes=SCOPES)
-    service = build('drive', 'v3', credentials=credentials)
+def _get_drive_service():
+    """
+    Trả về Drive service dùng chung, tạo ở lần gọi đầu tiên.
+    Discovery document lấy từ bản có sẵn trong thư viện (static_discovery) nên không tốn request HTTP,
+    service (và kết nối HTTP keep-alive bên trong) được dùng lại cho mọi lần upload.
+    """
+    global _drive_service
+    with _drive_lock:
+        if _drive_service is None:
+            _drive_service = build(
+                'drive', 'v3', credentials=_get_drive_credentials(),
+                cache_discovery=False, static_discovery=True)
+    return _drive_service
+
+def upload_to_googledrive(file_path: str) -> str:
+    """
+    Upload file lên Google Drive sử dụng service account.
+    Lấy thông tin credentials từ biến môi trường GOOGLE_SERVICE_ACCOUNT_INFO.
+    """
+    drive_service = _get_drive_service()
 
     file_metadata = {
         'name': os.path.basename(file_path),
-        'parents': [FOLDER_ID] if FOLDER_ID else []
+        'parents': [DRIVE_FOLDER_ID] if DRIVE_FOLDER_ID else []
     }
-    media = MediaFileUpload(file_path, mimetype='video/mp4')
-    uploaded_file = service.files().create(
+    # Upload resumable theo từng chunk: lỗi ở 1 chunk chỉ cần gửi lại chunk đó
+    media = MediaFileUpload(
+        file_path, mimetype='video/mp4', resumable=True, chunksize=DRIVE_UPLOAD_CHUNKSIZE)
+    request = drive_service.files().create(
         body=file_metadata, media_body=media, fields='id'
-    ).execute()
+    )
+    uploaded_file = None
+    while uploaded_file is None:
+        _, uploaded_file = _execute_with_backoff(request.next_chunk)
 
     file_id = uploaded_file.get('id')
 
@@ -95,92 +358,270 @@ def upload_to_googledrive(file_path: str) -> str:
         'type': 'anyone',
         'role': 'reader'
     }
-    service.permissions().create(
+    _execute_with_backoff(drive_service.permissions().create(
         fileId=file_id, body=permission
-    ).execute()
+    ).execute)
 
     # Trả về đường dẫn xem file trên Google Drive
     return f"https://drive.google.com/file/d/{file_id}/view?usp=sharing"
 
+@lru_cache(maxsize=None)
+def detect_video_encoder() -> str:
+    """
+    Chọn encoder H.264 đầu tiên mở được trên máy.
+    Encoder phần cứng có thể được build sẵn trong FFmpeg nhưng máy không có GPU,
+    nên mở thử encoder thay vì chỉ xem danh sách codec. Kết quả được cache.
+    """
+    for encoder, settings in VIDEO_ENCODERS.items():
+        if encoder == "libx264":
+            continue
+        try:
+            codec_context = av.CodecContext.create(encoder, "w")
+            codec_context.width = codec_context.height = 256
+            codec_context.pix_fmt = settings["pix_fmt"]
+            codec_context.time_base = Fraction(1, VIDEO_FPS)
+            codec_context.open()
+        except (av.FFmpegError, ValueError):
+            continue
+        return encoder
+    return "libx264"
+
+def concat_audio(audio_files: List[str], output_path: str):
+    """
+    Ghép các file audio bằng concat demuxer của ffmpeg.
+    Stream được copy nguyên (-c copy), không giải mã rồi encode lại như MoviePy,
+    nên yêu cầu các file cùng codec/tham số.
+    """
+    list_file = f"{output_path}.txt"
+    try:
+        with open(list_file, "w", encoding="utf-8") as f:
+            for file in audio_files:
+                f.write(f"file '{os.path.abspath(file)}'\n")
+        cmd = [
+            FFMPEG_BINARY, "-y", "-hide_banner", "-loglevel", "error",
+            "-f", "concat", "-safe", "0", "-i", list_file,
+            "-c", "copy", output_path,
+        ]
+        subprocess.run(cmd, check=True, capture_output=True, text=True)
+    finally:
+        if os.path.exists(list_file):
+            os.remove(list_file)
+
+def concat_audio_with_moviepy(audio_files: List[str], output_path: str):
+    """Ghép audio bằng MoviePy (encode lại), dùng khi các file khác codec nên không copy stream được"""
+    audio_clips = [AudioFileClip(file) for file in audio_files]
+    final_audio = concatenate_audioclips(audio_clips)
+    final_audio.write_audiofile(output_path)
+
+@lru_cache(maxsize=256)
+def render_text_image(text: str, font_size: int, width: int) -> Image.Image:
+    """
+    Vẽ chữ trắng trên nền trong suốt, tự xuống dòng theo chiều rộng width (như TextClip method='caption').
+    Kết quả được cache theo (text, font_size, width) nên không được sửa trực tiếp ảnh trả về.
+    """
+    font = ImageFont.truetype(font_path, font_size)
+
+    # Xuống dòng theo độ rộng thực tế (pixel) của từng từ
+    lines = []
+    for paragraph in text.splitlines() or [""]:
+        line = ""
+        for word in paragraph.split():
+            candidate = f"{line} {word}" if line else word
+            if line and font.getlength(candidate) > width:
+                lines.append(line)
+                line = word
+            else:
+                line = candidate
+        lines.append(line)
+
+    ascent, descent = font.getmetrics()
+    line_height = ascent + descent
+    image = Image.new("RGBA", (width, line_height * len(lines)), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    for idx, line in enumerate(lines):
+        draw.text((0, idx * line_height), line, font=font, fill=(255, 255, 255, 255))
+    return image
+
+def _paste_caption(background: Image.Image, caption: Image.Image, x: int, bottom: int):
+    """
+    Dán caption sao cho mép dưới nằm ở toạ độ bottom. Phần tràn ra ngoài ảnh (tên truyện dài
+    xuống nhiều dòng hơn chiều cao ảnh, ảnh quá hẹp) bị cắt bỏ như CompositeVideoClip trước đây,
+    vì alpha_composite không nhận toạ độ âm.
+    """
+    top = bottom - caption.height
+    right = min(caption.width, background.width - x)
+    if right <= 0 or bottom <= 0:
+        return
+    visible = caption.crop((0, max(0, -top), right, caption.height))
+    background.alpha_composite(visible, (x, max(0, top)))
+
+def compose_frame(story_name: str, chapter: str, image_path: str, frame_path: str):
+    """
+    Vẽ 2 dòng chữ lên ảnh nền một lần duy nhất và lưu thành 1 khung hình JPEG.
+    Video chỉ cần lặp lại khung hình này nên không cần ghép chữ theo từng frame.
+    """
+    with Image.open(image_path) as image:
+        # Ảnh CMYK/palette/grayscale được chuyển hết về RGBA ở đây, encoder chỉ nhận ảnh RGB
+        background = image.convert("RGBA")
+    # yuv420p (libx264/NVENC) yêu cầu chiều rộng/cao chẵn: cắt bớt 1 pixel lẻ ở mép phải/dưới
+    width, height = background.width // 2 * 2, background.height // 2 * 2
+    if (width, height) != background.size:
+        background = background.crop((0, 0, width, height))
+
+    # Dòng đầu font size 30, dòng thứ hai font size 20, góc dưới bên trái
+    margin = 10  # lề cách biên trái và dưới 10 pixel
+    # Ảnh rất hẹp vẫn cần chiều rộng dương để vẽ chữ, phần tràn ra ngoài sẽ bị cắt khi dán
+    text_width = max(1, width - 2 * margin)
+    line1 = render_text_image(story_name, 30, text_width)
+    line2 = render_text_image(chapter, 20, text_width)
+    _paste_caption(background, line1, margin, height - line2.height - margin * 2)
+    _paste_caption(background, line2, margin, height - margin)
+
+    background.convert("RGB").save(frame_path, "JPEG", quality=90)
+
+def render_with_av(frame_path: str, audio_path: str, video_file: str):
+    """
+    Lặp khung hình đã ghép chữ theo độ dài audio và encode thành video bằng PyAV.
+    Encoder chạy ngay trong process (không qua pipe tới ffmpeg), khung hình chỉ chuyển
+    sang pix_fmt của encoder một lần, audio được copy nguyên gói không encode lại.
+    """
+    encoder = detect_video_encoder()
+    settings = VIDEO_ENCODERS[encoder]
+
+    with Image.open(frame_path) as image:
+        frame = av.VideoFrame.from_image(image.convert("RGB")).reformat(format=settings["pix_fmt"])
+
+    with av.open(audio_path) as audio_input, av.open(video_file, mode="w") as output:
+        audio_input_stream = audio_input.streams.audio[0]
+        if audio_input.duration is not None:
+            duration = audio_input.duration / av.time_base
+        else:
+            duration = float(audio_input_stream.duration * audio_input_stream.time_base)
+
+        video_stream = output.add_stream(encoder, rate=VIDEO_FPS, options=settings["options"])
+        video_stream.width = frame.width
+        video_stream.height = frame.height
+        video_stream.pix_fmt = settings["pix_fmt"]
+        audio_stream = output.add_stream_from_template(audio_input_stream)
+
+        # Cùng một khung hình cho mỗi giây audio (VIDEO_FPS khung/giây)
+        for index in range(max(1, math.ceil(duration * VIDEO_FPS))):
+            frame.pts = index
+            output.mux(video_stream.encode(frame))
+        output.mux(video_stream.encode(None))
+
+        for packet in audio_input.demux(audio_input_stream):
+            # Gói rỗng cuối stream không có dts, không ghi
+            if packet.dts is None:
+                continue
+            packet.stream = audio_stream
+            output.mux(packet)
+
+def render_with_moviepy(frame_path: str, audio_path: str, video_file: str):
+    """Dựng video bằng MoviePy, chỉ dùng khi PyAV không dựng được (vd: encoder phần cứng lỗi)"""
+    final_audio = AudioFileClip(audio_path)
+    video_clip = ImageClip(frame_path, duration=final_audio.duration)
+    video_clip.audio = final_audio
+
+    # Xuất video ra file, dùng cùng tham số libx264 với PyAV
+    x264_options = VIDEO_ENCODERS["libx264"]["options"]
+    video_clip.write_videofile(
+        video_file, fps=VIDEO_FPS, preset=x264_options["preset"], threads=ENCODE_THREADS,
+        ffmpeg_params=["-tune", x264_options["tune"], "-crf", x264_options["crf"]]
+    )
+
+def render_video(frame_path: str, audio_path: str, video_file: str):
+    """Dựng video từ khung hình đã ghép chữ và audio đã ghép"""
+    try:
+        render_with_av(frame_path, audio_path, video_file)
+    except av.FFmpegError as e:
+        logger.warning("PyAV lỗi, chuyển sang MoviePy: %s", e)
+        render_with_moviepy(frame_path, audio_path, video_file)
+
+@contextmanager
+def timed_step(video_id: str, step: str):
+    """Đo thời gian 1 bước của process_video, ghi log và đưa vào histogram Prometheus"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        PROCESS_VIDEO_STEP_SECONDS.labels(step=step).observe(elapsed)
+        logger.info("video=%s step=%s elapsed=%.3f", video_id, step, elapsed)
+
+@celery_app.task
+def render_task(video_id: str, story_name: str, chapter: str, image_path: str, audio_urls: List[str]):
+    """Task Celery tạo video, upload lên Drive và gửi webhook"""
+    # Đếm số lần task được giao (kể cả khi được đưa lại hàng đợi do process con bị kill),
+    # task làm chết worker liên tục (vd: hết RAM) thì dừng hẳn thay vì giao lại mãi
+    key = _video_key(video_id)
+    with video_db_sync.pipeline(transaction=True) as pipe:
+        pipe.hincrby(key, "attempts", 1)
+        pipe.expire(key, VIDEO_TTL_SECONDS)
+        attempts, _ = pipe.execute()
+    if attempts > MAX_TASK_ATTEMPTS:
+        _update_video(video_id, {"status": f"error: worker lost {attempts - 1} times while processing"})
+        return
+    process_video(video_id, story_name, chapter, image_path, audio_urls)
+
 def process_video(video_id: str, story_name: str, chapter: str, image_path: str, audio_urls: List[str]):
     try:
-        # --- Bước 1: Tải các file audio về ---
-        audio_files = []
-        for idx, url in enumerate(audio_urls):
-            temp_audio_path = f"temp_audio_{video_id}_{idx}.mp3"
-            download_file(url, temp_audio_path)
-            audio_files.append(temp_audio_path)
-
-        # --- Bước 2: Ghép các audio thành 1 file duy nhất ---
-        audio_clips = [AudioFileClip(file) for file in audio_files]
-        final_audio = concatenate_audioclips(audio_clips)
-        final_audio_path = f"final_audio_{video_id}.mp3"
-        final_audio.write_audiofile(final_audio_path)
-
-        # --- Bước 3: Tạo video ---
-        # Tạo ImageClip từ hình ảnh với thời lượng bằng với audio ghép
-        image_clip = ImageClip(image_path, duration=final_audio.duration)
-
-        # Tạo text clip cho dòng đầu (font size 48)
-        text_clip1 = TextClip(
-            text=story_name,
-            font=font_path, method='caption', size=(image_clip.w - 2*10, None),
-            font_size=30,
-            color='white',
-            duration=final_audio.duration
-        )
+        # Mọi file tạm (audio, danh sách concat, video) nằm trong 1 thư mục tạm,
+        # được xoá cả thư mục khi kết thúc kể cả khi lỗi
+        with tempfile.TemporaryDirectory(prefix=f"video_{video_id}_") as work_dir:
+            # --- Bước 1: Tải các file audio về ---
+            audio_files = [os.path.join(work_dir, f"temp_audio_{idx}.mp3") for idx in range(len(audio_urls))]
+            with timed_step(video_id, "download"):
+                # process_video chạy trong Celery worker (không có event loop) nên tự tạo event loop riêng
+                asyncio.run(download_files(audio_urls, audio_files))
 
-        # Tạo text clip cho dòng thứ hai (font size 25)
-        text_clip2 = TextClip(
-            text=chapter,
-            font=font_path,
-            font_size=20, size=(image_clip.w - 2*10, None),
-            color='white',
-            duration=final_audio.duration
-        )
-        # Xác định vị trí của các text clip (góc dưới bên trái)
-        margin = 10  # lề cách biên trái và dưới 10 pixel
-        w, h = image_clip.size
-        line1_height = text_clip1.h
-        line2_height = text_clip2.h
-        text_clip1.pos = lambda t: (margin, h - line1_height - line2_height - margin * 2)
-        text_clip2.pos = lambda t: (margin, h - line2_height - margin)
-
-        # Ghép ImageClip và TextClip thành video
-        video_clip = CompositeVideoClip([image_clip, text_clip1, text_clip2]).with_duration(final_audio.duration)
-        video_clip.audio = final_audio
-
-        # Xuất video ra file
-        video_file = f"video_{video_id}.mp4"
-        video_clip.write_videofile(video_file, fps=24)
-
-        # --- Bước 4: Upload video lên Google Drive ---
-        video_url = upload_to_googledrive(video_file)
-        video_db[video_id]["status"] = "completed"
-        video_db[video_id]["url"] = video_url
+            # --- Bước 2: Ghép các audio thành 1 file duy nhất ---
+            final_audio_path = os.path.join(work_dir, "final_audio.mp3")
+            with timed_step(video_id, "concat"):
+                try:
+                    concat_audio(audio_files, final_audio_path)
+                except subprocess.CalledProcessError as e:
+                    logger.warning("Không ghép audio bằng stream copy được, chuyển sang MoviePy: %s", e.stderr)
+                    concat_audio_with_moviepy(audio_files, final_audio_path)
+
+            # --- Bước 3: Tạo video ---
+            frame_path = os.path.join(work_dir, "frame.jpg")
+            # Tên file cũng là tên trên Google Drive nên giữ dạng video_<id>.mp4
+            video_file = os.path.join(work_dir, f"video_{video_id}.mp4")
+            with timed_step(video_id, "render"):
+                compose_frame(story_name, chapter, image_path, frame_path)
+                # Celery worker đã là process riêng (và không được tạo process con) nên dựng trực tiếp
+                render_video(frame_path, final_audio_path, video_file)
+
+            # --- Bước 4: Upload video lên Google Drive ---
+            with timed_step(video_id, "upload"):
+                video_url = upload_to_googledrive(video_file)
+        _update_video(video_id, {"status": "completed", "url": video_url})
         send_webhook(video_id)
     except Exception as e:
-        video_db[video_id]["status"] = f"error: {str(e)}"
-    finally:
-        # --- Xoá các file tạm thời ---
-        for file in audio_files:
-            if os.path.exists(file):
-                os.remove(file)
-        if os.path.exists(final_audio_path):
-            os.remove(final_audio_path)
-        if os.path.exists(video_file):
-            os.remove(video_file)
+        _update_video(video_id, {"status": f"error: {str(e)}"})
+
+@retry(
+    stop=stop_after_attempt(RETRY_ATTEMPTS),
+    wait=_wait_retry_after,
+    retry=retry_if_exception(_is_retryable_webhook_error),
+    reraise=True,
+)
+def _post_webhook(url: str, data: dict) -> requests.Response:
+    """POST webhook, thử lại khi lỗi mạng, 429 hoặc 5xx"""
+    response = requests.post(url, json=data, timeout=WEBHOOK_TIMEOUT_SECONDS)
+    response.raise_for_status()
+    return response
 
 def send_webhook(video_id: str):
     """ Gửi webhook khi video hoàn thành """
-    task_info = video_db.get(video_id)
-    if not task_info or not task_info.get("webhook_url"):
+    task_info = _video_record(video_db_sync.hgetall(_video_key(video_id)))
+    if not task_info["webhook_url"]:
         return
 
     data = {"task_id": task_info["task_id"], "status": task_info["status"], "video_url": task_info["url"]}
     try:
-        response = requests.post(task_info["webhook_url"], json=data)
-        response.raise_for_status()
+        response = _post_webhook(task_info["webhook_url"], data)
         print(f"✅ Webhook gửi thành công: {response.json()}")
     except requests.exceptions.RequestException as e:
         print(f"❌ Lỗi webhook: {e}")
\ No newline at end of file